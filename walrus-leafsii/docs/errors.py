@@ -0,0 +1,34 @@
+
+# ============================================================
+# Protocol errors (shared by pseudocode_stable.py and rebalance_pool.py)
+# ============================================================
+# Callers catch the specific subclass (or ProtocolError for all of them)
+# instead of matching on messages.
+# ============================================================
+
+class ProtocolError(Exception):
+    pass
+
+class ConfigError(ProtocolError):
+    """Bad parameters at import, or modules used before bind_sp()/bind_core()."""
+
+class BadAmount(ProtocolError):
+    pass
+
+class BadTarget(ProtocolError):
+    pass
+
+class InsufficientReserve(ProtocolError):
+    pass
+
+class InsufficientSP(ProtocolError):
+    pass
+
+class OracleNotSet(ProtocolError):
+    pass
+
+class OracleStale(ProtocolError):
+    pass
+
+class OracleStep(ProtocolError):
+    pass
@@ -0,0 +1,64 @@
+
+# ============================================================
+# Fixed-point reference for the core kernels (pairs with pseudocode_stable.py)
+# ============================================================
+# - All monetary quantities are Python ints scaled by SCALE (1e18, wei-style):
+#     x_fp = int(Decimal(repr(x)) * SCALE)
+#   (through Decimal, so 0.1 becomes exactly 10**17 instead of picking up the
+#   float's binary error from x * SCALE)
+# - Python ints are arbitrary precision, so products never overflow; the only
+#   rounding is the floor in mul_fp / div_fp. That understates CR and Px, but
+#   f_burn_needed floors the *target* supply and so overstates the burn by up
+#   to one unit.
+# - Mirrors the float kernels in pseudocode_stable.py one-for-one, including
+#   their EPS guards (EPS_FP); pseudocode_stable.check_fixed_point() cross-checks
+#   the two after every L3 rebalance. The Move contracts use the same integer style.
+# ============================================================
+
+from __future__ import annotations
+
+from decimal import Decimal
+
+from errors import BadTarget
+
+SCALE = 10**18
+BPS   = 10_000
+EPS_FP = SCALE // 10**12   # pseudocode_stable.EPS (1e-12) in fixed point
+
+def to_fp(x: float) -> int:
+    return int(Decimal(repr(x)) * SCALE)
+
+def from_fp(x: int) -> float:
+    return x / SCALE
+
+def mul_fp(a: int, b: int) -> int:
+    return (a * b) // SCALE
+
+def div_fp(a: int, b: int) -> int:
+    return (a * SCALE) // b
+
+def apply_bps(a: int, bps: int) -> int:
+    return (a * bps) // BPS
+
+# ----------------------------
+# Kernels (integer twins of _reserve_net_sui, _cr, _px, _f_burn_needed)
+# ----------------------------
+def reserve_net_sui(reserve_sui: int, sp_obl: int) -> int:
+    return max(0, reserve_sui - sp_obl)
+
+def collateral_ratio(reserve_sui: int, sp_obl: int, p_sui: int, Nf: int, Pf: int) -> int:
+    denom = max(EPS_FP, mul_fp(Nf, Pf))
+    return div_fp(mul_fp(reserve_net_sui(reserve_sui, sp_obl), p_sui), denom)
+
+def px(reserve_sui: int, p_sui: int, Nf: int, Pf: int, Nx: int, px_prev: int) -> int:
+    # Px = (reserve_usd - Nf*Pf) / Nx; bootstrap keeps Px as-is
+    if Nx <= EPS_FP:
+        return px_prev
+    return max(0, div_fp(mul_fp(reserve_sui, p_sui) - mul_fp(Nf, Pf), Nx))
+
+def f_burn_needed(reserve_sui: int, sp_obl: int, p_sui: int, Nf: int, Pf: int, target_cr: int) -> int:
+    # Nf' = (reserve_net_sui * p_sui) / (target_cr * Pf); burn = max(0, Nf - Nf')
+    if target_cr <= 0:
+        raise BadTarget("bad target")
+    nf_target = div_fp(mul_fp(reserve_net_sui(reserve_sui, sp_obl), p_sui), mul_fp(target_cr, Pf))
+    return max(0, Nf - nf_target)
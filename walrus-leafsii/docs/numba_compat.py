@@ -0,0 +1,20 @@
+
+# ============================================================
+# Optional numba (shared by pseudocode_stable.py and rebalance_pool.py)
+# ============================================================
+# Kernels are compiled with numba when available (cached on disk under
+# __pycache__); without numba, njit is a no-op and prange is range, so the
+# same kernels run as plain Python with identical semantics.
+# ============================================================
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
@@ -15,8 +15,17 @@
 # ============================================================
 
 from __future__ import annotations
+import math
+import sys
 from dataclasses import dataclass
 
+import numpy as np
+
+import fixed_point as fp
+from errors import (BadAmount, BadTarget, ConfigError, InsufficientReserve,
+                    OracleNotSet, OracleStale, OracleStep)
+from numba_compat import njit
+
 # ---------------------------------------------
 # Parameters (configurable)
 # ---------------------------------------------
@@ -26,6 +35,12 @@ CR_T_L2 = 1.206   # User rebalance mode
 CR_T_L3 = 1.144   # Protocol rebalance
 CR_T_L4 = 1.050   # Emergency recap
 
+if not 0 < CR_T_L4 < CR_T_L3 < CR_T_L2 < CR_T_L1:
+    raise ConfigError("bad level config: need 0 < CR_T_L4 < CR_T_L3 < CR_T_L2 < CR_T_L1")
+
+# Ascending level thresholds; level = 5 - #(thresholds <= cr)
+_LEVEL_THRESHOLDS = np.array([CR_T_L4, CR_T_L3, CR_T_L2, CR_T_L1])
+
 # Economics
 BETA_F = 0.0      # <-- locked per request (Pf stays $1)
 PF_FIXED = 1.0
@@ -33,12 +48,17 @@ PF_FIXED = 1.0
 # Oracle safety
 MAX_STALENESS_SEC = 3600
 MAX_REL_STEP      = 0.20   # max 20% per update
+if MAX_STALENESS_SEC <= 0 or not 0 < MAX_REL_STEP < 1:
+    # a zero window would reject (or, for the step, freeze) every price update
+    raise ConfigError("bad oracle config: need MAX_STALENESS_SEC > 0 and 0 < MAX_REL_STEP < 1")
 
 # L3 pacing (also enforced inside SP)
 MAX_F_BURN_FRACTION_PER_CALL = 0.50
 
 EPS = 1e-12
 
+_INV_CR_T_L1 = 1.0 / CR_T_L1               # default rebalance target, hoisted out of the hot path
+
 # ---------------------------------------------
 # Global state (simplified)
 # ---------------------------------------------
@@ -47,47 +67,155 @@ Nx = 0.0                 # xToken supply
 Pf = PF_FIXED            # fToken NAV ($)
 Px = 0.0                 # xToken NAV ($), implied
 p_sui = 0.0              # SUI price ($)
+inv_p_sui = 0.0          # 1 / p_sui, refreshed with every oracle update
+inv_Pf = 1.0 / PF_FIXED  # 1 / Pf, refreshed with every oracle update
 last_oracle_ts = 0
 
 reserve_sui  = 0.0       # SUI reserve balance
 treasury_sui = 0.0       # Treasury SUI for bonuses/fees/etc.
 
-# Imported from SP module at runtime (single source of truth for obligations)
-# Here we assign placeholders so this file remains importable on its own;
-# when integrated, these will be bound by SP.bind_core(self) or by shared module scope.
-try:
-    from rebalance_pool import sp_obligation_sui, sp_quote_burn_cap, sp_controller_rebalance
-except Exception:
-    sp_obligation_sui = 0.0
-    def sp_quote_burn_cap() -> float:
-        return 0.0
-    def sp_controller_rebalance(f_burn: float, payout_sui: float) -> tuple[float, float]:
-        return 0.0, 0.0
+# Derived values, published as one immutable snapshot (_publish_epoch) exactly
+# once, at the tail of the outermost mutator of reserve_sui / sp_obligation_sui
+# / p_sui / Nf / Nx / Pf, core or SP. Reads never see a half-updated state.
+@dataclass(frozen=True)
+class Epoch:
+    cr: float
+    level: int
+    px: float
+    reserve_usd: float
+    claims_usd: float     # Nf*Pf + Nx*Px, the invariant's other side
+    reserve_net_sui: float
+    reserve_net_usd: float
+    ts: int               # oracle timestamp the snapshot was priced at
+
+_epoch = Epoch(cr=0.0, level=5, px=0.0, reserve_usd=0.0, claims_usd=0.0,
+               reserve_net_sui=0.0, reserve_net_usd=0.0, ts=0)
+
+# Stability Pool hooks (single source of truth for obligations). Installed once
+# at startup by bind_sp(rebalance_pool), which wires both directions. Until then
+# every hook raises ConfigError: a core without its SP cannot tell reserve owed
+# to depositors from reserve it may pay out.
+def _sp_unbound(*args, **kwargs):
+    raise ConfigError("SP not bound: call bind_sp() at startup")
+
+class _SPBinding:
+    __slots__ = ("obligation_sui", "quote_burn", "controller_rebalance")
+
+    def __init__(self):
+        self.obligation_sui = _sp_unbound
+        self.quote_burn = _sp_unbound
+        self.controller_rebalance = _sp_unbound
+
+SP = _SPBinding()
+
+def _require_sp():
+    """Fail before a mutator touches state, not at its closing _publish_epoch()."""
+    if SP.obligation_sui is _sp_unbound: _sp_unbound()
+
+def bind_sp(sp):
+    """Wire the core and the SP module to each other (same as sp.bind_core(core))."""
+    SP.obligation_sui = lambda: sp.sp_obligation_sui
+    SP.quote_burn = sp.sp_quote_burn
+    SP.controller_rebalance = sp._sp_controller_rebalance_quoted
+    sp._install_core_hooks(sys.modules[__name__])
+    _publish_epoch()
+
+# ---------------------------------------------
+# Kernels (pure scalar math; state passed in as floats)
+# ---------------------------------------------
+@njit(cache=True, fastmath=True)
+def _reserve_net_sui(reserve_sui: float, sp_obl: float) -> float:
+    return max(0.0, reserve_sui - sp_obl)
+
+@njit(cache=True, fastmath=True)
+def _cr(reserve_sui: float, sp_obl: float, p_sui: float, Nf: float, Pf: float) -> float:
+    return max(0.0, reserve_sui - sp_obl) * p_sui / max(EPS, Nf * Pf)
+
+@njit(cache=True, fastmath=True)
+def _px(reserve_sui: float, p_sui: float, Nf: float, Pf: float, Nx: float, px_prev: float) -> float:
+    # Px implied from invariant: reserve_usd = Nf*Pf + Nx*Px  => Px = (reserve_usd - Nf*Pf)/Nx
+    if Nx <= EPS:
+        # Bootstrap: keep Px as-is (or set policy value)
+        return px_prev
+    return max(0.0, (reserve_sui * p_sui - Nf * Pf) / max(EPS, Nx))
+
+@njit(cache=True, fastmath=True)
+def _f_burn_needed(reserve_sui: float, sp_obl: float, p_sui: float,
+                   Nf: float, inv_Pf: float, inv_target_cr: float) -> float:
+    nf_target = max(0.0, reserve_sui - sp_obl) * p_sui * inv_target_cr * inv_Pf
+    return max(0.0, Nf - nf_target)
+
+# Oracle tick result codes (raises do not cross the JIT boundary cheaply)
+_ORACLE_OK    = 0
+_ORACLE_STALE = 1
+_ORACLE_STEP  = 2
+
+# Rejections indexed by code; a fresh exception is built only on the (rare)
+# rejection path, so no state is shared between raises or threads.
+_ORACLE_ERRS = (None, (OracleStale, "oracle too stale"), (OracleStep, "oracle step too large"))
+
+@njit(cache=True)
+def _oracle_tick(p_new: float, now_ts: int, last_ts: int, p_sui: float,
+                 reserve_sui: float, Nf: float, Nx: float, px_prev: float,
+                 max_staleness: int, max_rel_step: float, pf_fixed: float):
+    """Staleness + step check, Pf reset and Px recompute in one pass.
+    Returns (code, p_sui', Pf', Px'); state is unchanged unless code == _ORACLE_OK.
+    Governance parameters are passed in (not read as globals, which numba
+    freezes at compile time) so runtime changes take effect."""
+    if last_ts != 0:
+        if now_ts - last_ts > max_staleness:
+            return _ORACLE_STALE, p_sui, pf_fixed, px_prev
+        if abs(p_new / max(EPS, p_sui) - 1.0) > max_rel_step:
+            return _ORACLE_STEP, p_sui, pf_fixed, px_prev
+    # β_f = 0 -> Pf fixed to 1.0; keep explicit in case of future governance change
+    return _ORACLE_OK, p_new, pf_fixed, _px(reserve_sui, p_new, Nf, pf_fixed, Nx, px_prev)
+
+# Warm-up: compile (or load from cache) at import so the first call is not slow
+_reserve_net_sui(1.0, 0.0)
+_cr(1.0, 0.0, 1.0, 1.0, 1.0)
+_px(1.0, 1.0, 1.0, 1.0, 1.0, 0.0)
+_f_burn_needed(1.0, 0.0, 1.0, 1.0, 1.0, _INV_CR_T_L1)
+_oracle_tick(1.0, 1, 0, 0.0, 0.0, 0.0, 0.0, 0.0, MAX_STALENESS_SEC, MAX_REL_STEP, PF_FIXED)
 
 # ---------------------------------------------
 # Helpers
 # ---------------------------------------------
+def _publish_epoch():
+    global _epoch
+    sp_obl = SP.obligation_sui()
+    cr = _cr(reserve_sui, sp_obl, p_sui, Nf, Pf)
+    net_sui = _reserve_net_sui(reserve_sui, sp_obl)
+    _epoch = Epoch(
+        cr=cr,
+        level=current_level(cr),
+        px=Px,
+        reserve_usd=reserve_sui * p_sui,
+        claims_usd=Nf * Pf + Nx * Px,
+        reserve_net_sui=net_sui,
+        reserve_net_usd=net_sui * p_sui,
+        ts=last_oracle_ts,
+    )
+
+def read_snapshot() -> Epoch:
+    """Self-consistent (cr, level, Px, reserve) view as of the last state change."""
+    return _epoch
+
 def reserve_usd() -> float:
-    return reserve_sui * p_sui
+    return _epoch.reserve_usd
 
 def reserve_net_sui() -> float:
     # Net of indexed-but-unpaid SP obligations (deferred model)
-    return max(0.0, reserve_sui - sp_obligation_sui)
+    return _epoch.reserve_net_sui
 
 def reserve_net_usd() -> float:
-    return reserve_net_sui() * p_sui
+    return _epoch.reserve_net_usd
 
 def collateral_ratio() -> float:
-    denom = max(EPS, Nf * Pf)
-    return reserve_net_usd() / denom
+    return _epoch.cr
 
 def _update_px():
     global Px
-    # Px implied from invariant: reserve_usd = Nf*Pf + Nx*Px  => Px = (reserve_usd - Nf*Pf)/Nx
-    if Nx <= EPS:
-        # Bootstrap: keep Px as-is (or set policy value)
-        return
-    Px = max(0.0, (reserve_usd() - (Nf * Pf)) / max(EPS, Nx))
+    Px = _px(reserve_sui, p_sui, Nf, Pf, Nx, Px)
 
 # ---------------------------------------------
 # Oracle + NAV updater (atomic)
@@ -97,33 +225,33 @@ def update_from_oracle(p_new: float, now_ts: int):
     Single source of truth for price and NAV updates.
     With β_f = 0, Pf stays at $1; Px is recomputed from the invariant.
     """
-    global p_sui, last_oracle_ts, Pf
-    if last_oracle_ts != 0:
-        # Staleness
-        if now_ts - last_oracle_ts > MAX_STALENESS_SEC:
-            raise Exception("oracle too stale")
-        # Max step
-        rel = abs(p_new / max(EPS, p_sui) - 1.0)
-        if rel > MAX_REL_STEP:
-            raise Exception("oracle step too large")
-
-    p_sui = p_new
-    last_oracle_ts = now_ts
-
-    # β_f = 0 -> Pf fixed to 1.0; keep explicit in case of future governance change
-    Pf = PF_FIXED
-    _update_px()
+    global p_sui, last_oracle_ts, Pf, Px, inv_p_sui, inv_Pf
+    _require_sp()
+    code, p, pf, px = _oracle_tick(p_new, now_ts, last_oracle_ts, p_sui, reserve_sui, Nf, Nx, Px,
+                                  MAX_STALENESS_SEC, MAX_REL_STEP, PF_FIXED)
+    if code:
+        exc, msg = _ORACLE_ERRS[code]
+        raise exc(msg)
+    p_sui, last_oracle_ts, Pf, Px = p, now_ts, pf, px
+    inv_p_sui, inv_Pf = 1.0 / max(EPS, p), 1.0 / pf
+    _publish_epoch()
 
 # ---------------------------------------------
 # Mode helpers
 # ---------------------------------------------
-def current_level() -> int:
-    cr = collateral_ratio()
-    if cr >= CR_T_L1: return 1
-    if cr >= CR_T_L2: return 2
-    if cr >= CR_T_L3: return 3
-    if cr >= CR_T_L4: return 4
-    return 5  # emergency recap
+def current_level(cr: float | None = None) -> int:
+    # cr >= CR_T_L1 -> 1, ..., cr >= CR_T_L4 -> 4, below -> 5 (emergency recap)
+    # NaN CR (bad oracle input) fails closed to 5; searchsorted would sort NaN above L1.
+    # +inf (e.g. no supply) stays level 1, as in the comparison cascade.
+    if cr is None: return _epoch.level
+    if math.isnan(cr): return 5
+    return 5 - int(np.searchsorted(_LEVEL_THRESHOLDS, cr, side="right"))
+
+def current_levels(cr_array) -> np.ndarray:
+    """Batched current_level() over a series of CRs."""
+    cr_array = np.asarray(cr_array, dtype=np.float64)
+    levels = 5 - np.searchsorted(_LEVEL_THRESHOLDS, cr_array, side="right")
+    return np.where(np.isnan(cr_array), 5, levels).astype(np.uint8)
 
 # ---------------------------------------------
 # Mint / Redeem (sketches; fee policy omitted for brevity)
@@ -133,11 +261,13 @@ def mint_ftoken(deposit_sui: float) -> float:
     User deposits SUI; protocol issues fToken at Pf (=$1).
     """
     global reserve_sui, Nf
-    if deposit_sui <= 0: raise Exception("bad amount")
+    _require_sp()
+    if deposit_sui <= 0: raise BadAmount("bad amount")
     reserve_sui += deposit_sui
-    issued_f = deposit_sui * p_sui / Pf
+    issued_f = deposit_sui * p_sui * inv_Pf
     Nf += issued_f
     _update_px()
+    _publish_epoch()
     return issued_f
 
 def redeem_ftoken(burn_f: float) -> float:
@@ -145,13 +275,16 @@ def redeem_ftoken(burn_f: float) -> float:
     User returns fToken; receives SUI at Pf (less fees by level; omitted).
     """
     global reserve_sui, Nf
-    if burn_f <= 0 or burn_f > Nf: raise Exception("bad amount")
-    sui_out = burn_f * Pf / p_sui
+    _require_sp()
+    if burn_f <= 0 or burn_f > Nf: raise BadAmount("bad amount")
+    if p_sui <= EPS: raise OracleNotSet("oracle not set")
+    sui_out = burn_f * Pf * inv_p_sui
     # In deferred model this *direct* redemption is paid now.
-    if sui_out > reserve_net_sui(): raise Exception("insufficient reserve net of SP obligations")
+    if sui_out > reserve_net_sui(): raise InsufficientReserve("insufficient reserve net of SP obligations")
     reserve_sui -= sui_out
     Nf -= burn_f
     _update_px()
+    _publish_epoch()
     return sui_out
 
 # (xToken mint/redeem omitted; governed by fee table & invariant preservation)
@@ -166,9 +299,9 @@ def _compute_f_burn_needed_for_target(target_cr: float) -> float:
     => Nf' = (reserve_net_sui * p_sui) / (target_cr * Pf)
     f_burn_needed = max(0, Nf - Nf')
     """
-    if target_cr <= 0: raise Exception("bad target")
-    nf_target = (reserve_net_sui() * p_sui) / (target_cr * Pf)
-    return max(0.0, Nf - nf_target)
+    if target_cr <= 0: raise BadTarget("bad target")
+    inv_target_cr = _INV_CR_T_L1 if target_cr == CR_T_L1 else 1.0 / target_cr
+    return _f_burn_needed(reserve_sui, SP.obligation_sui(), p_sui, Nf, inv_Pf, inv_target_cr)
 
 def protocol_rebalance_L3_to_target(target_cr: float = CR_T_L1) -> tuple[float, float]:
     """
@@ -177,28 +310,31 @@ def protocol_rebalance_L3_to_target(target_cr: float = CR_T_L1) -> tuple[float,
     Returns (burned_f, indexed_sui).
     """
     global Nf
+    # Local snapshot of globals read on this path (LOAD_FAST instead of dict lookups)
+    p, pf, nf, eps, sp = p_sui, Pf, Nf, EPS, SP
 
-    if p_sui <= EPS: raise Exception("oracle not set")
-    if Nf <= EPS:    return (0.0, 0.0)
+    _require_sp()
+    if p <= eps: raise OracleNotSet("oracle not set")
 
-    # Need and cap
+    # Need and cap (SP-side fraction cap); no supply / no need both yield f_burn <= EPS
     need = _compute_f_burn_needed_for_target(target_cr)
-    if need <= EPS: return (0.0, 0.0)
-
-    cap_sp = sp_quote_burn_cap()  # SP-side fraction cap
-    f_burn = max(0.0, min(need, cap_sp, Nf))
-    if f_burn <= EPS: return (0.0, 0.0)
+    cap_sp, f_total_sp = sp.quote_burn()
+    f_burn = max(0.0, min(need, cap_sp, nf))
+    if f_burn <= eps: return (0.0, 0.0)
 
-    payout_sui = f_burn * Pf / p_sui
+    payout_sui = f_burn * pf * inv_p_sui
 
     # Ask SP to (a) pro‑rata shrink deposits and (b) index SUI obligation
-    burned, indexed_sui = sp_controller_rebalance(f_burn=f_burn, payout_sui=payout_sui)
-    if burned <= EPS:
+    burned, indexed_sui = sp.controller_rebalance(f_burn=f_burn, payout_sui=payout_sui,
+                                                  f_total_pre=f_total_sp, cap=cap_sp)
+    if burned <= eps:
         return (0.0, 0.0)
 
     # Burn the liability now (single source of truth)
-    Nf -= burned
+    Nf = nf - burned
     _update_px()
+    _publish_epoch()
+    assert check_fixed_point(), "float rebalance kernels drifted from fixed_point.py"
     # IMPORTANT: Do NOT touch reserve_sui here (deferred).
     return (burned, indexed_sui)
 
@@ -210,10 +346,12 @@ def emergency_recapitalization(target_sui: float) -> float:
     Governance-controlled recap to raise reserve_sui immediately (outside SP).
     """
     global reserve_sui
+    _require_sp()
     if target_sui <= 0: return 0.0
     raised = min(target_sui, _raise_collateral_via_governance(target_sui))
     reserve_sui += raised
     _update_px()
+    _publish_epoch()
     return raised
 
 def _raise_collateral_via_governance(target_sui: float) -> float:
@@ -222,7 +360,7 @@ def _raise_collateral_via_governance(target_sui: float) -> float:
 
 
 # ---------------------------------------------
-# Callback example for SP.claim()
+# Payment hooks for SP.sp_claim() / SP.sp_claim_batch() (see rebalance_pool.bind_core)
 # ---------------------------------------------
 def sp_claim_pay_sui(amount_sui: float):
     """
@@ -231,20 +369,47 @@ def sp_claim_pay_sui(amount_sui: float):
     in the deferred model.
     """
     global reserve_sui
+    _require_sp()
     if amount_sui <= 0: return
     if amount_sui > reserve_sui + EPS:
-        raise Exception("insufficient reserve to honor SP claim")
+        raise InsufficientReserve("insufficient reserve to honor SP claim")
     reserve_sui -= amount_sui
+    _update_px()   # Px is implied by the invariant, so it absorbs the reserve change
+    # No publish here: the SP releases the obligation next and then republishes
+    # once, so no snapshot mixes the new reserve with the old obligation.
+
+def sp_claim_pay_sui_batch(total_sui: float):
+    """
+    Batched form of sp_claim_pay_sui for SP.sp_claim_batch(): one reserve
+    decrement for the aggregate of many users' indexed SUI.
+    """
+    sp_claim_pay_sui(total_sui)
 
 # ---------------------------------------------
 # Invariants & sanity checks
 # ---------------------------------------------
-def check_invariant(tol: float = 1e-6) -> bool:
+def check_invariant(rel_tol: float = 1e-12, abs_tol: float = 1e-6) -> bool:
     # n_eth·p_eth ≈ n_f·p_f + n_x·p_x   (SP obligations do not affect invariant)
-    lhs = reserve_usd()
-    rhs = Nf*Pf + Nx*Px
-    return abs(lhs - rhs) <= tol
+    # Both sides come from the same published snapshot; an exact match (e.g. no
+    # xToken yet) skips the tolerance test. Tolerance scales with the larger side
+    # so protocol-sized balances don't fail on rounding.
+    e = _epoch
+    lhs, rhs = e.reserve_usd, e.claims_usd
+    if lhs == rhs: return True
+    return abs(lhs - rhs) <= max(abs_tol, rel_tol * max(abs(lhs), abs(rhs)))
+
+def check_fixed_point(rel_tol: float = 1e-9, abs_tol: float = 1e-9) -> bool:
+    # Float kernels vs their 1e18 integer twins (fixed_point.py) on the live state.
+    # The twins floor to 1e-18 rather than being exact, hence the tolerance.
+    r, o, p, nf, pf = (fp.to_fp(v) for v in (reserve_sui, SP.obligation_sui(), p_sui, Nf, Pf))
+    pairs = (
+        (_cr(reserve_sui, SP.obligation_sui(), p_sui, Nf, Pf), fp.collateral_ratio(r, o, p, nf, pf)),
+        (_px(reserve_sui, p_sui, Nf, Pf, Nx, Px), fp.px(r, p, nf, pf, fp.to_fp(Nx), fp.to_fp(Px))),
+        (_f_burn_needed(reserve_sui, SP.obligation_sui(), p_sui, Nf, inv_Pf, _INV_CR_T_L1),
+         fp.f_burn_needed(r, o, p, nf, pf, fp.to_fp(CR_T_L1))),
+    )
+    return all(abs(a - fp.from_fp(b)) <= max(abs_tol, rel_tol * abs(a)) for a, b in pairs)
 
 def check_solvency() -> bool:
     # Reserve must cover SP obligations
-    return reserve_sui + EPS >= sp_obligation_sui
+    return reserve_sui + EPS >= SP.obligation_sui()
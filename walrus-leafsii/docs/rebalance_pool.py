@@ -4,7 +4,10 @@
 # ============================================================
 # - Users deposit fToken into SP (shares). We track scaled-shares:
 #     actual_f_total = sp_scaled_total * sp_scale
-#     user_actual_f  = user.sp_scaled * sp_scale
+#     user_actual_f  = sp_users.sp_scaled[i] * sp_scale
+# - Per-user state is one packed 24-byte record per user (USER_DT), so a
+#   single-user op touches one cache line; field views (sp_users.sp_scaled,
+#   ...) still let settlement over many users run as a single vector op.
 # - Protocol L3 rebalance uses a *pro‑rata burn* of SP deposits and indexes
 #   SUI obligation to depositors: no SUI leaves reserve at L3 time.
 # - Users later claim SUI (or rToken) which *then* reduces reserve_sui and
@@ -13,11 +16,12 @@
 
 from __future__ import annotations
 
-# Pull selected globals from core if available (for type hints only)
-try:
-    from pseudocode_stable import Pf, p_sui, reserve_sui  # noqa: F401
-except Exception:
-    pass
+import sys
+
+import numpy as np
+
+from errors import BadAmount, ConfigError, InsufficientSP
+from numba_compat import HAVE_NUMBA, njit, prange
 
 # ----------------------------
 # Parameters
@@ -28,6 +32,15 @@ SP_MAX_BURN_FRAC_CALL  = 0.50     # cap per controller call (safety / pacing)
 BPS = 10_000
 EPS = 1e-12
 
+# Large settlement batches are reduced across cores (numba only; the pure-Python
+# fallback of the kernel would be far slower than the NumPy path)
+PAR_SETTLE_MIN_ROWS = 1 << 16     # below this, thread start-up outweighs the parallel win
+
+if not 0 < SP_MAX_BURN_FRAC_CALL <= 1:
+    raise ConfigError("bad SP config: need 0 < SP_MAX_BURN_FRAC_CALL <= 1")
+if not 0 <= HARVEST_BOUNTY_BPS <= BPS:
+    raise ConfigError("bad SP config: need 0 <= HARVEST_BOUNTY_BPS <= BPS")
+
 # ----------------------------
 # State
 # ----------------------------
@@ -36,12 +49,108 @@ sp_scaled_total: float = 0.0     # sum of user scaled shares
 sp_index_sui_scaled: float = 0.0 # cumulative SUI-per-scaled-share
 sp_obligation_sui: float = 0.0   # SUI owed to SP depositors (deferred)
 
-# Per-user record (example shape; host app should manage storage)
-class SPUser:
+# Core hooks, installed once at startup by bind_core(pseudocode_stable), which
+# wires both directions. Until then every hook raises ConfigError.
+def _core_unbound(*args, **kwargs):
+    raise ConfigError("core not bound: call bind_core() at startup")
+
+class _CoreBinding:
+    __slots__ = ("pay_sui", "pay_sui_batch", "state_changed", "check_invariant", "check_solvency")
+
     def __init__(self):
-        self.ftoken_balance = 0.0  # free fTokens (not in SP)
-        self.sp_scaled      = 0.0  # scaled shares
-        self.sp_index_snap  = 0.0  # last index snapshot
+        self.pay_sui = _core_unbound
+        self.pay_sui_batch = _core_unbound
+        self.state_changed = _core_unbound   # core snapshot derived from sp_obligation_sui
+        self.check_invariant = _core_unbound
+        self.check_solvency = _core_unbound
+
+CORE = _CoreBinding()
+
+def _require_core():
+    """Fail before a mutator touches state, not at its closing CORE.state_changed()."""
+    if CORE.state_changed is _core_unbound: _core_unbound()
+
+def _install_core_hooks(core):
+    CORE.pay_sui = core.sp_claim_pay_sui
+    CORE.pay_sui_batch = core.sp_claim_pay_sui_batch
+    CORE.state_changed = core._publish_epoch
+    CORE.check_invariant = core.check_invariant
+    CORE.check_solvency = core.check_solvency
+
+def bind_core(core):
+    """Wire the SP and the core module to each other (same as core.bind_sp(sp))."""
+    core.bind_sp(sys.modules[__name__])
+
+# Kahan compensation terms for the two long-running accumulators above
+_sp_index_c: float = 0.0
+_sp_obl_c: float = 0.0
+
+def _kahan_add(s: float, c: float, x: float) -> tuple[float, float]:
+    """Compensated s + x; returns (new_sum, new_compensation)."""
+    y = x - c
+    t = s + y
+    return t, (t - s) - y
+
+def _pay_hook(cb, name: str):
+    """Explicit callback, else the bound core's hook; fails before any state changes."""
+    _require_core()
+    return cb or getattr(CORE, name)
+
+def _release_obligation(amount_sui: float):
+    """Reduce sp_obligation_sui after SUI has been paid out of the core reserve.
+    Callers republish the core snapshot once their whole update is done."""
+    global sp_obligation_sui, _sp_obl_c
+    sp_obligation_sui, _sp_obl_c = _kahan_add(sp_obligation_sui, _sp_obl_c, -amount_sui)
+    # per-user owed is rounded independently of the accumulator; never go negative
+    if sp_obligation_sui < 0: sp_obligation_sui, _sp_obl_c = 0.0, 0.0
+
+# Per-user records (example shape; host app should manage storage)
+USER_DT = np.dtype([
+    ("scaled", "<f8"),   # scaled shares
+    ("snap",   "<f8"),   # last index snapshot
+    ("bal",    "<f8"),   # free fTokens (not in SP)
+])
+
+class SPUsers:
+    def __init__(self, capacity: int = 64):
+        self.rec = np.zeros(capacity, dtype=USER_DT)
+        self.index: dict = {}    # addr -> row
+        self.n = 0
+
+    # Strided per-field views for full sweeps (writes go through to rec)
+    @property
+    def sp_scaled(self) -> np.ndarray:
+        return self.rec["scaled"]
+
+    @property
+    def sp_index_snap(self) -> np.ndarray:
+        return self.rec["snap"]
+
+    @property
+    def ftoken_balance(self) -> np.ndarray:
+        return self.rec["bal"]
+
+    def add(self, addr) -> int:
+        """Return the row for addr, allocating a zeroed one on first use."""
+        i = self.index.get(addr)
+        if i is not None:
+            return i
+        if self.n == self.rec.shape[0]:
+            rec = np.zeros(2 * self.rec.shape[0], dtype=USER_DT)
+            rec[:self.n] = self.rec[:self.n]
+            self.rec = rec
+        i = self.n
+        self.index[addr] = i
+        self.n += 1
+        return i
+
+sp_users = SPUsers()
+
+# Queued user ops (kind, row, amount), drained by sp_tick()
+OP_DEPOSIT  = 0
+OP_WITHDRAW = 1
+OP_CLAIM    = 2
+_pending_ops: list[tuple[int, int, float]] = []
 
 # ----------------------------
 # Views
@@ -49,6 +158,11 @@ class SPUser:
 def sp_total_f() -> float:
     return sp_scaled_total * sp_scale
 
+def sp_quote_burn() -> tuple[float, float]:
+    # (per-call cap, pre-burn total); the core passes both to _sp_controller_rebalance_quoted
+    f_total = sp_scaled_total * sp_scale
+    return SP_MAX_BURN_FRAC_CALL * f_total, f_total
+
 def sp_quote_burn_cap() -> float:
     # per-call cap
     return SP_MAX_BURN_FRAC_CALL * sp_total_f()
@@ -59,24 +173,32 @@ def sp_quote_burn_cap() -> float:
 def sp_controller_rebalance(f_burn: float, payout_sui: float) -> tuple[float, float]:
     """
     Core requests to burn f_burn from SP and index payout_sui in SUI.
-    We may reduce both by cap; we:
-      1) compute pre-burn totals,
-      2) compute allowed_burn (cap),
-      3) shrink sp_scale by burn fraction,
-      4) add allowed_payout / sp_scaled_total to the index,
-      5) increase sp_obligation_sui by allowed_payout.
+    Quotes the pool itself, then runs _sp_controller_rebalance_quoted.
     Returns (burned_f, indexed_sui).
     """
-    global sp_scale, sp_index_sui_scaled, sp_obligation_sui
+    _require_core()
+    cap, f_total = sp_quote_burn()
+    return _sp_controller_rebalance_quoted(f_burn, payout_sui, f_total, cap)
 
-    f_total_pre = sp_total_f()
-    if f_total_pre <= EPS or f_burn <= EPS:
-        return (0.0, 0.0)
-
-    # Cap the burn
-    allowed_burn = min(f_burn, SP_MAX_BURN_FRAC_CALL * f_total_pre)
+def _sp_controller_rebalance_quoted(f_burn: float, payout_sui: float,
+                                    f_total_pre: float, cap: float) -> tuple[float, float]:
+    """
+    sp_controller_rebalance with the sp_quote_burn() quote taken by the caller
+    in the same call (the core's bound hook); the quote is trusted as is.
+    We may reduce both by cap; we:
+      1) compute allowed_burn (cap),
+      2) shrink sp_scale by burn fraction,
+      3) add allowed_payout / sp_scaled_total to the index,
+      4) increase sp_obligation_sui by allowed_payout.
+    Returns (burned_f, indexed_sui).
+    """
+    global sp_scale, sp_index_sui_scaled, sp_obligation_sui, _sp_index_c, _sp_obl_c
+    # Local snapshot of globals read on this path; written back once at the end
+    scale, scaled_total, eps, kahan = sp_scale, sp_scaled_total, EPS, _kahan_add
 
-    if allowed_burn <= EPS:
+    # Cap the burn; an empty pool or a dust request both collapse to <= EPS here
+    allowed_burn = max(0.0, min(f_burn, cap))
+    if allowed_burn <= eps or scaled_total <= eps:
         return (0.0, 0.0)
 
     # Scale the payout proportionally if we cut the requested burn
@@ -84,15 +206,18 @@ def sp_controller_rebalance(f_burn: float, payout_sui: float) -> tuple[float, fl
     allowed_payout = sui_per_f * allowed_burn
 
     # 1) Index: use *scaled* denominator snapshot
-    if sp_scaled_total <= EPS:
-        return (0.0, 0.0)
-    delta = allowed_payout / sp_scaled_total
-    sp_index_sui_scaled += delta
-    sp_obligation_sui   += allowed_payout
+    delta = allowed_payout / scaled_total
+    index, index_c = kahan(sp_index_sui_scaled, _sp_index_c, delta)
+    obl, obl_c     = kahan(sp_obligation_sui, _sp_obl_c, allowed_payout)
 
     # 2) Pro-rata burn via scale shrink
     frac = allowed_burn / f_total_pre               # fraction of total burnt
-    sp_scale *= max(0.0, 1.0 - frac)                # shrink scale
+    scale *= max(0.0, 1.0 - frac)                   # shrink scale
+
+    sp_index_sui_scaled, _sp_index_c = index, index_c
+    sp_obligation_sui, _sp_obl_c     = obl, obl_c
+    sp_scale = scale
+    # The calling core burns Nf and republishes its snapshot once, afterwards.
 
     # NOTE: we do NOT touch reserve_sui here (deferred model).
     return (allowed_burn, allowed_payout)
@@ -100,58 +225,193 @@ def sp_controller_rebalance(f_burn: float, payout_sui: float) -> tuple[float, fl
 # ----------------------------
 # User flows
 # ----------------------------
-def _settle_user(user: SPUser) -> float:
-    """Accrue pending SUI to be paid to user (but do not pay yet)."""
-    owed = user.sp_scaled * (sp_index_sui_scaled - user.sp_index_snap)
-    user.sp_index_snap = sp_index_sui_scaled
-    return max(0.0, owed)
+@njit(parallel=True, cache=True)
+def _owed_par(scaled, snap, idx, index):
+    # per-row owed + total, rows split across threads in contiguous chunks
+    owed = np.empty(idx.shape[0])
+    total = 0.0
+    for k in prange(idx.shape[0]):
+        i = idx[k]
+        o = max(0.0, scaled[i] * (index - snap[i]))
+        owed[k] = o
+        total += o
+    return owed, total
+
+def _pending_owed(idx: np.ndarray) -> tuple[np.ndarray, float]:
+    """Owed SUI per row in idx and its total; does not move snapshots."""
+    u, index = sp_users, sp_index_sui_scaled
+    if HAVE_NUMBA and idx.shape[0] >= PAR_SETTLE_MIN_ROWS:
+        return _owed_par(u.sp_scaled, u.sp_index_snap, idx, index)
+    owed = np.maximum(0.0, u.sp_scaled[idx] * (index - u.sp_index_snap[idx]))
+    return owed, float(owed.sum())
+
+def _unique_rows(idx) -> np.ndarray:
+    """idx as an intp array; a repeated row would be settled (and paid) twice."""
+    idx = np.asarray(idx, dtype=np.intp)
+    if np.unique(idx).shape[0] != idx.shape[0]:
+        raise BadAmount("duplicate user rows")
+    return idx
+
+def _settle_user(idx):
+    """
+    Accrue pending SUI for user row(s) idx (but do not pay yet).
+    idx may be a single row or an array of unique rows (duplicates raise
+    BadAmount); returns owed per row.
+    """
+    if np.ndim(idx):
+        idx = _unique_rows(idx)
+    u, index = sp_users, sp_index_sui_scaled
+    owed = np.maximum(0.0, u.sp_scaled[idx] * (index - u.sp_index_snap[idx]))
+    u.sp_index_snap[idx] = index
+    return owed
 
-def sp_deposit(user: SPUser, f_amount: float):
+def sp_deposit(i: int, f_amount: float):
     """User deposits fToken into SP (settles rewards first)."""
     global sp_scaled_total
-    if f_amount <= 0.0 or user.ftoken_balance < f_amount:
-        raise Exception("bad amount")
-    newly = _settle_user(user)   # so index snapshots are fair
+    r = sp_users.rec[i]
+    if f_amount <= 0.0 or r["bal"] < f_amount:
+        raise BadAmount("bad amount")
+    newly = _settle_user(i)   # so index snapshots are fair
     # (protocol may auto-claim here, but we keep obligation until claim)
     scaled = f_amount / sp_scale
-    user.ftoken_balance -= f_amount
-    user.sp_scaled += scaled
+    r["bal"] -= f_amount
+    r["scaled"] += scaled
     sp_scaled_total += scaled
 
-def sp_withdraw(user: SPUser, f_amount: float):
+def sp_withdraw(i: int, f_amount: float):
     """User withdraws fToken from SP (settles rewards first)."""
     global sp_scaled_total
+    r = sp_users.rec[i]
     if f_amount <= 0.0:
-        raise Exception("bad amount")
-    newly = _settle_user(user)
+        raise BadAmount("bad amount")
+    newly = _settle_user(i)
     # available actual f
-    available = user.sp_scaled * sp_scale
+    available = r["scaled"] * sp_scale
     if f_amount > available + EPS:
-        raise Exception("insufficient SP balance")
+        raise InsufficientSP("insufficient SP balance")
     scaled = f_amount / sp_scale
-    user.sp_scaled -= scaled
+    r["scaled"] -= scaled
     sp_scaled_total -= scaled
-    user.ftoken_balance += f_amount
+    r["bal"] += f_amount
 
-def sp_claim(user: SPUser, core_pay_sui_cb):
+def sp_claim(i: int, core_pay_sui_cb=None):
     """
     User pulls their accrued SUI. This is the *only* place where reserve_sui is reduced.
     core_pay_sui_cb(amount_sui) must:
       - reduce core.reserve_sui by amount_sui
       - transfer amount_sui to user
-    (SP reduces sp_obligation_sui itself)
+    (SP reduces sp_obligation_sui itself). Defaults to the bound core's hook.
+    The snapshot only advances after the callback succeeds.
     """
-    global sp_obligation_sui
-    owed = _settle_user(user)
+    pay = _pay_hook(core_pay_sui_cb, "pay_sui")
+    r, index = sp_users.rec[i], sp_index_sui_scaled
+    owed = max(0.0, float(r["scaled"] * (index - r["snap"])))
     if owed <= EPS:
         return 0.0
     # callback performs the state transitions on the core side
-    core_pay_sui_cb(owed)
-    sp_obligation_sui -= owed
-    # guard against drift
-    if sp_obligation_sui < 0: sp_obligation_sui = 0.0
+    pay(owed)
+    r["snap"] = index
+    _release_obligation(owed)
+    CORE.state_changed()
+    return owed
+
+def sp_claim_batch(idx, core_pay_sui_batch_cb=None):
+    """
+    Claim for many users at once; idx is an array of unique user rows
+    (duplicates raise BadAmount before any state changes).
+    core_pay_sui_batch_cb(total_sui) is called once with the aggregate and must
+    reduce core.reserve_sui by it; the returned per-row owed vector tells the
+    host how to split the transfer. Snapshots are only advanced after the
+    callback succeeds. The callback defaults to the bound core's hook.
+    """
+    pay = _pay_hook(core_pay_sui_batch_cb, "pay_sui_batch")
+    idx = _unique_rows(idx)
+    owed, total = _pending_owed(idx)
+    if total <= EPS:
+        return np.zeros_like(owed)
+    pay(total)
+    sp_users.sp_index_snap[idx] = sp_index_sui_scaled
+    _release_obligation(total)
+    CORE.state_changed()
     return owed
 
+# ----------------------------
+# Batched tick (queued user flows)
+# ----------------------------
+def enqueue_deposit(i: int, f_amount: float):
+    _pending_ops.append((OP_DEPOSIT, i, f_amount))
+
+def enqueue_withdraw(i: int, f_amount: float):
+    _pending_ops.append((OP_WITHDRAW, i, f_amount))
+
+def enqueue_claim(i: int):
+    _pending_ops.append((OP_CLAIM, i, 0.0))
+
+def sp_tick(core_pay_sui_batch_cb=None):
+    """
+    Drain the op queue in one pass:
+      a) settle every touched user (one vector op),
+      b) apply deposits, c) apply withdraws (net per user),
+      d) pay all settled SUI with a single core_pay_sui_batch_cb(total) call.
+    Every touched user is auto-claimed in (d), so settling before a deposit or
+    withdraw never strands accrued SUI. Each user's net amount is validated
+    before any state changes; an invalid batch (including rows outside
+    [0, sp_users.n)) is rejected and stays queued, as does a batch whose
+    payment fails. A
+    tick must not break the core invariant or solvency if they held before it.
+    Returns (rows, owed) so the host can split the SUI transfer. The callback
+    defaults to the bound core's hook.
+    """
+    global sp_scaled_total
+    pay = _pay_hook(core_pay_sui_batch_cb, "pay_sui_batch")
+    n_ops = len(_pending_ops)
+    if not n_ops:
+        return np.zeros(0, dtype=np.intp), np.zeros(0)
+    ops = np.asarray(_pending_ops[:n_ops], dtype=np.float64)
+    kind, rows, amt = ops[:, 0], ops[:, 1].astype(np.intp), ops[:, 2]
+    u, index, scale = sp_users, sp_index_sui_scaled, sp_scale
+    if rows.min() < 0 or rows.max() >= u.n:
+        raise BadAmount("bad user row")
+
+    inv_before, solv_before = CORE.check_invariant(), CORE.check_solvency()
+
+    # Validate: per-user net deposit / withdraw against balances
+    touched, inv = np.unique(rows, return_inverse=True)
+    is_dep, is_wd = kind == OP_DEPOSIT, kind == OP_WITHDRAW
+    if np.any(amt[is_dep | is_wd] <= 0.0):
+        raise BadAmount("bad amount")
+    dep = np.zeros(touched.shape[0])
+    wd = np.zeros(touched.shape[0])
+    np.add.at(dep, inv[is_dep], amt[is_dep])
+    np.add.at(wd, inv[is_wd], amt[is_wd])
+    net = dep - wd
+    if np.any(net > u.ftoken_balance[touched]):
+        raise BadAmount("bad amount")
+    if np.any(-net > u.sp_scaled[touched] * scale + EPS):
+        raise InsufficientSP("insufficient SP balance")
+
+    # a) + d) settle and pay in one transfer (before shares change)
+    owed, total = _pending_owed(touched)
+    if total > EPS:
+        pay(total)
+        _release_obligation(total)
+    else:
+        owed[:] = 0.0
+    # Dequeue only what was processed; ops queued by the callback wait for the next tick
+    del _pending_ops[:n_ops]
+    u.sp_index_snap[touched] = index
+
+    # b) + c) deposits and withdraws, netted per user
+    scaled = net / scale
+    u.ftoken_balance[touched] -= net
+    u.sp_scaled[touched] += scaled
+    sp_scaled_total += float(scaled.sum())
+    CORE.state_changed()
+
+    assert CORE.check_invariant() or not inv_before, "sp_tick broke the core invariant"
+    assert CORE.check_solvency() or not solv_before, "sp_tick broke core solvency"
+    return touched, owed
+
 # ----------------------------
 # Yield harvest indexing (optional)
 # ----------------------------
@@ -160,13 +420,15 @@ def sp_index_harvest(yield_sui: float, caller_addr=None) -> float:
     Index natural staking yield into SP (less bounty).
     Returns bounty paid to caller (pull-based elsewhere).
     """
-    global sp_index_sui_scaled, sp_obligation_sui
+    global sp_index_sui_scaled, sp_obligation_sui, _sp_index_c, _sp_obl_c
+    _require_core()
     if yield_sui <= EPS or sp_scaled_total <= EPS:
         return 0.0
     bounty = (yield_sui * HARVEST_BOUNTY_BPS) / BPS
     to_pool = yield_sui - bounty
     delta = to_pool / sp_scaled_total
-    sp_index_sui_scaled += delta
-    sp_obligation_sui   += to_pool
+    sp_index_sui_scaled, _sp_index_c = _kahan_add(sp_index_sui_scaled, _sp_index_c, delta)
+    sp_obligation_sui, _sp_obl_c     = _kahan_add(sp_obligation_sui, _sp_obl_c, to_pool)
+    CORE.state_changed()
     # Bounty is owed as well (can be a separate small pot); we skip for brevity.
     return bounty